@@ -55,14 +55,17 @@ const API = {
      * @param {Object} params
      * @param {string} params.imageBase64 - Base64 PNG изображения
      * @param {string} params.maskBase64 - Base64 PNG маски
+     * @param {string[]} params.masksBase64 - Base64 PNG отдельных масок (регионы)
      * @param {string} params.prompt - Текстовый промпт
      * @param {Object} params.settings - Настройки (strength, guidance, etc.)
      * @param {string} params.cacheDir - Путь к папке кэша
+     * @param {string} params.mode - 'full' | 'draft' | 'refine'
      */
-    async inpaint({ imageBase64, maskBase64, prompt, settings, cacheDir }) {
+    async inpaint({ imageBase64, maskBase64, masksBase64, prompt, settings, cacheDir, mode }) {
         const body = {
             image: imageBase64,
             mask: maskBase64,
+            masks: masksBase64 || [],
             prompt: prompt || '',
             negative_prompt: settings.negativePrompt || '',
             strength: settings.strength || 0.85,
@@ -70,7 +73,9 @@ const API = {
             num_steps: settings.steps || 30,
             controlnet_scale: settings.controlnetScale || 0.5,
             seed: settings.seed || null,
-            cache_dir: cacheDir || null
+            deepcache_interval: settings.deepcacheInterval || 1,
+            cache_dir: cacheDir || null,
+            mode: mode || 'full'
         };
 
         const controller = new AbortController();
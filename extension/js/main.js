@@ -10,6 +10,8 @@ let csInterface;
 let isProcessing = false;
 let extensionPath = null;
 let serverProcess = null;
+// Контекст последнего черновика (для кнопки Refine)
+let lastDraft = null;
 
 const elements = {};
 
@@ -55,6 +57,7 @@ function init() {
     // Cache elements first
     elements.btnInpaint = document.getElementById('btn-inpaint');
     elements.btnStop = document.getElementById('btn-stop');
+    elements.btnRefine = document.getElementById('btn-refine');
     elements.btnToggleSettings = document.getElementById('btn-toggle-settings');
     elements.btnDebug = document.getElementById('btn-debug');
     elements.btnClearCache = document.getElementById('btn-clear-cache');
@@ -65,6 +68,8 @@ function init() {
     elements.strength = document.getElementById('strength');
     elements.guidance = document.getElementById('guidance');
     elements.steps = document.getElementById('steps');
+    elements.draftFirst = document.getElementById('draft-first');
+    elements.fastMode = document.getElementById('fast-mode');
 
     // Load jsx manually (symlink fix)
     loadJSX();
@@ -90,6 +95,7 @@ function init() {
     // Event handlers
     elements.btnInpaint.addEventListener('click', handleInpaint);
     elements.btnStop.addEventListener('click', handleStop);
+    elements.btnRefine.addEventListener('click', handleRefine);
     elements.btnToggleSettings.addEventListener('click', handleToggleSettings);
     elements.btnDebug.addEventListener('click', handleDebugExport);
     elements.btnClearCache.addEventListener('click', handleClearCache);
@@ -147,11 +153,16 @@ function showProgress(text) {
 
 function hideProgress() {
     elements.btnInpaint.disabled = false;
+    elements.btnRefine.disabled = false;
     elements.btnInpaint.textContent = 'Inpaint';
     elements.btnStop.classList.add('hidden');
     isProcessing = false;
 }
 
+function showRefineButton(visible) {
+    elements.btnRefine.classList.toggle('hidden', !visible);
+}
+
 function showStopButton() {
     elements.btnStop.classList.remove('hidden');
 }
@@ -266,22 +277,50 @@ function getSettings() {
     return {
         strength: parseFloat(elements.strength.value),
         guidance: parseFloat(elements.guidance.value),
-        steps: parseInt(elements.steps.value)
+        steps: parseInt(elements.steps.value),
+        deepcacheInterval: parseInt(elements.fastMode.value)
     };
 }
 
+function warnIfFastModeSkipped(settings, result) {
+    if (settings.deepcacheInterval > 1 && result.deepcache_interval <= 1) {
+        log('Fast mode unavailable on server (DeepCache not installed), ran full quality', 'error');
+    }
+}
+
+async function ensureServer() {
+    if (!(await isServerOnline())) {
+        showProgress('Starting server...');
+        await startServer();
+        await new Promise(r => setTimeout(r, 1000));
+    }
+}
+
+async function importResult(result, projectInfo, layerInfo, suffix, layerName) {
+    showProgress('Importing...');
+    const outputDir = projectInfo.projectPath + '/_AI_OUT';
+    const resultPath = `${outputDir}/${projectInfo.compName}_frame${projectInfo.currentFrame}_${suffix}.png`;
+    await base64ToFile(result.result, resultPath);
+
+    const imported = await evalScript(
+        `importResultAsLayer("${resultPath.replace(/\\/g, '/')}", ${layerInfo.index}, "${layerName}")`
+    );
+    if (imported.error) throw new Error(imported.error);
+
+    log(`Done: ${imported.layerName}`, 'success');
+    return imported;
+}
+
 async function handleInpaint() {
     if (isProcessing) return;
 
     try {
         showProgress('Preparing...');
+        showRefineButton(false);
+        lastDraft = null;
 
         // Start server if needed
-        if (!(await isServerOnline())) {
-            showProgress('Starting server...');
-            await startServer();
-            await new Promise(r => setTimeout(r, 1000));
-        }
+        await ensureServer();
 
         log('Starting inpaint...', 'info');
 
@@ -303,12 +342,13 @@ async function handleInpaint() {
         if (layerInfo.error) throw new Error(layerInfo.error);
         log(`Layer: ${layerInfo.name}, Mask: ${layerInfo.selectedMaskName}`, 'info');
 
-        // 3. Export
+        // 3. Export (separate masks only for full mode — draft/refine use the combined mask)
+        const draft = elements.draftFirst.checked;
         showProgress('Exporting...');
         const cacheDir = projectInfo.projectPath + '/_AI_CACHE';
         log('Cache dir: ' + cacheDir, 'info');
         const exportResult = await evalScript(
-            `exportForInpaint(${layerInfo.index}, ${layerInfo.selectedMaskIndex}, "${cacheDir.replace(/\\/g, '/')}")`
+            `exportForInpaint(${layerInfo.index}, ${layerInfo.selectedMaskIndex}, "${cacheDir.replace(/\\/g, '/')}", ${!draft})`
         );
         log('Export result: ' + JSON.stringify(exportResult), 'info');
         if (exportResult.error) throw new Error(exportResult.error);
@@ -319,40 +359,100 @@ async function handleInpaint() {
         const maskBase64 = await fileToBase64(exportResult.maskPath);
         log(`Image b64: ${imageBase64.length}, Mask b64: ${maskBase64.length}`, 'info');
 
-        // 6. Inpaint
-        showProgress('AI processing...');
+        // Several masks: one request, server inpaints each region crop
+        const masksBase64 = [];
+        for (const maskPath of exportResult.maskPaths || []) {
+            masksBase64.push(await fileToBase64(maskPath));
+        }
+        if (masksBase64.length > 1) {
+            log(`Masks: ${masksBase64.length} (one pass)`, 'info');
+        }
+
+        // 6. Inpaint (or fast draft)
+        const prompt = elements.prompt.value.trim();
+        const settings = getSettings();
+        showProgress(draft ? 'AI draft...' : 'AI processing...');
         showStopButton();
-        log('Running inference...', 'info');
+        log(draft ? 'Running draft...' : 'Running inference...', 'info');
 
         const result = await API.inpaint({
             imageBase64,
             maskBase64,
-            prompt: elements.prompt.value.trim(),
-            settings: getSettings(),
-            cacheDir: projectInfo.projectPath
+            masksBase64: draft ? [] : masksBase64,
+            prompt,
+            settings,
+            cacheDir: projectInfo.projectPath,
+            mode: draft ? 'draft' : 'full'
         });
 
         log(result.cached ? 'From cache' : 'Inference done', 'success');
+        warnIfFastModeSkipped(settings, result);
+
+        // 7. Save result and import to AE
+        if (draft) {
+            const draftLayer = await importResult(result, projectInfo, layerInfo, 'draft', 'Inpaint Draft');
+            lastDraft = {
+                imageBase64, maskBase64, prompt, settings, projectInfo, layerInfo,
+                draftLayerIndex: draftLayer.layerIndex,
+                draftLayerName: draftLayer.layerName
+            };
+            showRefineButton(true);
+            log('Click Refine to render full quality', 'info');
+        } else {
+            await importResult(result, projectInfo, layerInfo, 'result', 'Inpaint Result');
+        }
 
-        // 7. Save result
-        showProgress('Importing...');
-        const outputDir = projectInfo.projectPath + '/_AI_OUT';
-        const resultPath = `${outputDir}/${projectInfo.compName}_frame${projectInfo.currentFrame}_result.png`;
-        await base64ToFile(result.result, resultPath);
+    } catch (error) {
+        log(`Error: ${error.message}`, 'error');
+    } finally {
+        hideProgress();
+        // Stop server after inpaint
+        stopServer();
+    }
+}
 
-        // 8. Import to AE
-        const importResult = await evalScript(
-            `importResultAsLayer("${resultPath.replace(/\\/g, '/')}", ${layerInfo.index}, "Inpaint Result")`
-        );
-        if (importResult.error) throw new Error(importResult.error);
+async function handleRefine() {
+    if (isProcessing || !lastDraft) return;
+
+    const {
+        imageBase64, maskBase64, prompt, settings, projectInfo, layerInfo,
+        draftLayerIndex, draftLayerName
+    } = lastDraft;
+
+    try {
+        showProgress('Preparing...');
+        elements.btnRefine.disabled = true;
+        await ensureServer();
 
-        log(`Done: ${importResult.layerName}`, 'success');
+        showProgress('AI refining...');
+        showStopButton();
+        log('Refining draft...', 'info');
+
+        // Черновик сервер берёт из кэша проекта
+        const result = await API.inpaint({
+            imageBase64,
+            maskBase64,
+            prompt,
+            settings,
+            cacheDir: projectInfo.projectPath,
+            mode: 'refine'
+        });
+
+        log(result.cached ? 'From cache' : 'Refine done', 'success');
+        warnIfFastModeSkipped(settings, result);
+
+        // Draft layer is replaced by the refined result
+        const removed = await evalScript(`removeLayer(${draftLayerIndex}, "${draftLayerName}")`);
+        if (removed.error) log(`Draft layer kept: ${removed.error}`, 'info');
+
+        await importResult(result, projectInfo, layerInfo, 'result', 'Inpaint Result');
+        lastDraft = null;
+        showRefineButton(false);
 
     } catch (error) {
         log(`Error: ${error.message}`, 'error');
     } finally {
         hideProgress();
-        // Stop server after inpaint
         stopServer();
     }
 }
@@ -110,8 +110,8 @@ AEI.getSelectedLayerWithMask = function() {
     }
 };
 
-// Render ALL layer masks as PNG (combined)
-AEI.renderLayerMask = function(layerIndex, maskIndex, outputPath) {
+// Render ALL layer masks as PNG (combined), or only maskIndex if singleMask
+AEI.renderLayerMask = function(layerIndex, maskIndex, outputPath, singleMask) {
     var comp = app.project.activeItem;
 
     if (!comp || !(comp instanceof CompItem)) {
@@ -155,8 +155,9 @@ AEI.renderLayerMask = function(layerIndex, maskIndex, outputPath) {
         whiteSolid.rotation.setValue(layer.rotation.valueAtTime(comp.time, false));
 
         // Add ALL masks from the layer (not just selected one)
-        var numMasks = layer.mask.numProperties;
-        for (var i = 1; i <= numMasks; i++) {
+        var firstMask = singleMask ? maskIndex : 1;
+        var lastMask = singleMask ? maskIndex : layer.mask.numProperties;
+        for (var i = firstMask; i <= lastMask; i++) {
             var sourceMask = layer.mask(i);
             var newMask = whiteSolid.mask.addProperty("ADBE Mask Atom");
 
@@ -174,7 +175,7 @@ AEI.renderLayerMask = function(layerIndex, maskIndex, outputPath) {
 
         tempComp.remove();
 
-        return JSON.stringify({ success: true, path: outputPath, masksUsed: numMasks });
+        return JSON.stringify({ success: true, path: outputPath, masksUsed: lastMask - firstMask + 1 });
 
     } catch (e) {
         try {
@@ -282,8 +283,40 @@ AEI.importResultAsLayer = function(pngPath, sourceLayerIndex, layerName) {
     }
 };
 
-// Export for inpainting
-AEI.exportForInpaint = function(layerIndex, maskIndex, outputFolder) {
+// Remove layer (only if it still has the expected name)
+AEI.removeLayer = function(layerIndex, expectedName) {
+    var comp = app.project.activeItem;
+
+    if (!comp || !(comp instanceof CompItem)) {
+        return JSON.stringify({ error: "No active composition" });
+    }
+
+    try {
+        if (layerIndex < 1 || layerIndex > comp.numLayers) {
+            return JSON.stringify({ error: "Layer not found" });
+        }
+
+        var layer = comp.layer(layerIndex);
+        if (layer.name !== expectedName) {
+            return JSON.stringify({ error: "Layer " + layerIndex + " is not " + expectedName });
+        }
+
+        var source = layer.source;
+        layer.remove();
+        // Drop the imported footage if nothing else uses it
+        if (source && source.usedIn.length === 0) {
+            source.remove();
+        }
+
+        return JSON.stringify({ success: true });
+
+    } catch (e) {
+        return JSON.stringify({ error: "Remove failed: " + e.toString() });
+    }
+};
+
+// Export for inpainting (separateMasks: also each mask to its own PNG)
+AEI.exportForInpaint = function(layerIndex, maskIndex, outputFolder, separateMasks) {
     var comp = app.project.activeItem;
 
     if (!comp || !(comp instanceof CompItem)) {
@@ -311,10 +344,25 @@ AEI.exportForInpaint = function(layerIndex, maskIndex, outputFolder) {
         return JSON.stringify({ error: "Mask export failed: " + maskResult.error });
     }
 
+    // Each mask separately: the server groups nearby regions into crops
+    var maskPaths = [];
+    var numMasks = comp.layer(layerIndex).mask.numProperties;
+    if (separateMasks && numMasks > 1) {
+        for (var i = 1; i <= numMasks; i++) {
+            var singlePath = outputFolder + "/" + prefix + "_mask" + i + ".png";
+            var singleResult = JSON.parse(AEI.renderLayerMask(layerIndex, i, singlePath, true));
+            if (singleResult.error) {
+                return JSON.stringify({ error: "Mask " + i + " export failed: " + singleResult.error });
+            }
+            maskPaths.push(singlePath);
+        }
+    }
+
     return JSON.stringify({
         success: true,
         imagePath: imagePath,
         maskPath: maskPath,
+        maskPaths: maskPaths,
         frame: currentFrame,
         compName: comp.name
     });
@@ -328,8 +376,9 @@ AEI.testJSXLoaded = function() {
 // Create global aliases for easier calling
 function getProjectInfo() { return $.global.AEInpaint.getProjectInfo(); }
 function getSelectedLayerWithMask() { return $.global.AEInpaint.getSelectedLayerWithMask(); }
-function renderLayerMask(a,b,c) { return $.global.AEInpaint.renderLayerMask(a,b,c); }
+function renderLayerMask(a,b,c,d) { return $.global.AEInpaint.renderLayerMask(a,b,c,d); }
 function renderLayerSolo(a,b) { return $.global.AEInpaint.renderLayerSolo(a,b); }
 function importResultAsLayer(a,b,c) { return $.global.AEInpaint.importResultAsLayer(a,b,c); }
-function exportForInpaint(a,b,c) { return $.global.AEInpaint.exportForInpaint(a,b,c); }
+function removeLayer(a,b) { return $.global.AEInpaint.removeLayer(a,b); }
+function exportForInpaint(a,b,c,d) { return $.global.AEInpaint.exportForInpaint(a,b,c,d); }
 function testJSXLoaded() { return $.global.AEInpaint.testJSXLoaded(); }
@@ -0,0 +1,84 @@
+"""
+Бенчмарк старта сервера: время до "Application startup complete" и до
+первого ответа /health.
+
+Запуск (из папки server, в venv):
+    python bench_startup.py [--runs 5] [--port 7861]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+def wait_for_line(proc: subprocess.Popen, marker: str, timeout: float) -> bool:
+    """Читает stderr uvicorn до строки с marker"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = proc.stderr.readline()
+        if not line:
+            return False
+        if marker in line:
+            return True
+    return False
+
+
+def wait_for_health(port: int, timeout: float) -> dict:
+    """Опрашивает /health до первого успешного ответа"""
+    url = f"http://127.0.0.1:{port}/health"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                return json.loads(response.read())
+        except OSError:
+            time.sleep(0.02)
+    raise TimeoutError(f"/health not ready after {timeout}s")
+
+
+def measure(port: int, timeout: float) -> tuple:
+    """Один запуск: (секунд до startup complete, секунд до /health)"""
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        if not wait_for_line(proc, "Application startup complete", timeout):
+            raise RuntimeError("Server exited before startup complete")
+        startup = time.monotonic() - start
+        wait_for_health(port, timeout)
+        health = time.monotonic() - start
+        return startup, health
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    startups, healths = [], []
+    for i in range(args.runs):
+        startup, health = measure(args.port, args.timeout)
+        startups.append(startup)
+        healths.append(health)
+        print(f"run {i + 1}: startup complete {startup:.3f}s, /health {health:.3f}s")
+
+    print(
+        f"median: startup complete {statistics.median(startups):.3f}s, "
+        f"/health {statistics.median(healths):.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,24 @@ DEFAULT_GUIDANCE_SCALE = 7.5
 DEFAULT_CONTROLNET_SCALE = 0.5
 DEFAULT_NUM_INFERENCE_STEPS = 30
 
+# Несколько масок на слое: регионы инпейнтятся кропами
+REGION_PADDING = 0.5        # контекст вокруг маски (доля её размера); близкие маски сливаются
+REGION_MIN_PADDING = 32     # минимальный контекст в px
+REGION_MIN_SIZE = 512       # длинная сторона кропа для модели: не меньше...
+REGION_MAX_SIZE = 1024      # ...и не больше
+REGION_MAX_BATCH = 4        # кропов одного размера за один вызов pipeline
+
+# DeepCache: ветка UNet, чьи выходы переиспользуются между шагами (0 = макс. ускорение)
+DEEPCACHE_BRANCH_ID = 0
+
+# Прогрессивный режим: быстрый черновик, затем уточнение от черновика
+DRAFT_MAX_SIZE = 512
+DRAFT_NUM_STEPS = 12
+DEFAULT_REFINE_STRENGTH = 0.5
+
+# Tiled VAE на CPU/CUDA для кадров от этой площади (px); None = выключено
+VAE_TILING_MIN_PIXELS = 768 * 768
+
 # Негативный промпт для манхвы
 DEFAULT_NEGATIVE_PROMPT = (
     "blurry, low quality, watermark, signature, "
@@ -39,5 +57,17 @@ OUTPUT_DIR_NAME = "_AI_OUT"
 # Кэш
 CACHE_ENABLED = True
 
+# Приблизительный поиск в кэше для перерендеренных кадров (шум цветоуправления).
+# Допуск в битах 256-битного перцептивного хэша; None = только точное совпадение
+CACHE_NEAR_MATCH_DISTANCE = 6
+# Максимальная поканальная разница пикселей с закэшированным входом (0-255)
+CACHE_NEAR_MATCH_PIXEL_DIFF = 8
+
+# Кэш сконвертированных весов .ckpt/.safetensors (None = конвертировать при каждом старте)
+CONVERTED_MODELS_DIR = MODELS_DIR / "converted"
+
+# Импортировать torch/diffusers в фоне сразу после старта (иначе — при первом инференсе)
+PRELOAD_ML_STACK = True
+
 # Логирование
 LOG_LEVEL = "INFO"
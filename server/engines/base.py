@@ -2,7 +2,7 @@
 Базовый класс для движков инпейнтинга
 """
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import List, Optional
 from PIL import Image
 
 
@@ -31,6 +31,10 @@ class BaseEngine(ABC):
         """Проверяет загружена ли модель"""
         pass
 
+    def warmup(self) -> None:
+        """Заранее импортирует тяжёлые зависимости (по умолчанию ничего)"""
+        pass
+
     @abstractmethod
     def inpaint(
         self,
@@ -43,6 +47,7 @@ class BaseEngine(ABC):
         num_inference_steps: int = 30,
         controlnet_scale: float = 0.5,
         seed: Optional[int] = None,
+        deepcache_interval: int = 1,
     ) -> Image.Image:
         """
         Выполняет инпейнтинг.
@@ -57,12 +62,30 @@ class BaseEngine(ABC):
             num_inference_steps: Количество шагов
             controlnet_scale: Сила ControlNet (0.0-1.0)
             seed: Сид для воспроизводимости
+            deepcache_interval: Полный пересчёт UNet раз в N шагов (1 = всегда)
 
         Returns:
             Результат инпейнтинга (RGB)
         """
         pass
 
+    def inpaint_batch(
+        self,
+        images: List[Image.Image],
+        masks: List[Image.Image],
+        **kwargs,
+    ) -> List[Image.Image]:
+        """
+        Инпейнтинг нескольких изображений одного размера.
+
+        По умолчанию — по одному через inpaint(); движки с поддержкой
+        батчей переопределяют.
+        """
+        return [
+            self.inpaint(image, mask, **kwargs)
+            for image, mask in zip(images, masks)
+        ]
+
     @property
     @abstractmethod
     def name(self) -> str:
@@ -74,3 +97,8 @@ class BaseEngine(ABC):
     def supports_controlnet(self) -> bool:
         """Поддерживает ли движок ControlNet"""
         pass
+
+    @property
+    def supports_feature_cache(self) -> bool:
+        """Поддерживает ли движок кэширование фич UNet (deepcache_interval > 1)"""
+        return False
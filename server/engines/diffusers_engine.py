@@ -1,10 +1,14 @@
 """
 Движок инпейнтинга на основе Diffusers + SDXL
 """
+import importlib.util
 import logging
-from typing import Optional
+import shutil
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
 
-import torch
 from PIL import Image
 
 from .base import BaseEngine
@@ -23,25 +27,55 @@ class DiffusersEngine(BaseEngine):
         model_id: str = "diffusers/stable-diffusion-xl-1.0-inpainting-0.1",
         controlnet_id: Optional[str] = None,
         device: Optional[str] = None,
+        converted_cache_dir: Optional[Path] = None,
+        vae_tiling_min_pixels: Optional[int] = None,
+        deepcache_branch_id: int = 0,
     ):
         self.model_id = model_id
         self.controlnet_id = controlnet_id
-
-        # Определяем устройство
-        if device:
-            self.device = device
-        elif torch.backends.mps.is_available():
-            self.device = "mps"
-        elif torch.cuda.is_available():
-            self.device = "cuda"
-        else:
-            self.device = "cpu"
+        # Папка для diffusers-копий single-file чекпоинтов (None = не кэшировать)
+        self.converted_cache_dir = converted_cache_dir
+        # Порог (ширина*высота) для tiled VAE на CPU/CUDA (None = никогда)
+        self.vae_tiling_min_pixels = vae_tiling_min_pixels
+        self._vae_tiled = False
+        self._prompt_cache = None
+        # Ветка UNet, выход которой переиспользуется в DeepCache (0 = самая мелкая)
+        self.deepcache_branch_id = deepcache_branch_id
+
+        # Устройство определяется при первом обращении: torch импортируется
+        # лениво, чтобы HTTP-слой сервера поднимался без ML-стека
+        self._device = device
 
         self.pipe = None
         self.controlnet = None
         self.lineart_processor = None
 
-        logger.info(f"DiffusersEngine initialized, device: {self.device}")
+        logger.info(f"DiffusersEngine initialized, device: {device or 'auto'}")
+
+    @property
+    def device(self) -> str:
+        """Устройство инференса (импортирует torch при первом вызове)"""
+        if self._device is None:
+            import torch
+
+            if torch.backends.mps.is_available():
+                self._device = "mps"
+            elif torch.cuda.is_available():
+                self._device = "cuda"
+            else:
+                self._device = "cpu"
+            logger.info(f"Device resolved: {self._device}")
+        return self._device
+
+    def known_device(self) -> Optional[str]:
+        """Устройство, если оно уже определено (без импорта torch)"""
+        return self._device
+
+    def warmup(self) -> None:
+        """Импортирует torch/diffusers заранее и определяет устройство"""
+        import diffusers  # noqa: F401
+
+        logger.info(f"ML stack imported, device: {self.device}")
 
     @property
     def name(self) -> str:
@@ -51,6 +85,11 @@ class DiffusersEngine(BaseEngine):
     def supports_controlnet(self) -> bool:
         return self.controlnet is not None
 
+    @property
+    def supports_feature_cache(self) -> bool:
+        # find_spec не импортирует пакет — проверка не тянет torch
+        return importlib.util.find_spec("DeepCache") is not None
+
     def is_loaded(self) -> bool:
         return self.pipe is not None
 
@@ -62,6 +101,7 @@ class DiffusersEngine(BaseEngine):
 
         logger.info(f"Loading Inpainting model: {self.model_id}")
 
+        import torch
         from diffusers import StableDiffusionInpaintPipeline
 
         # Check if loading from local .ckpt file or HuggingFace
@@ -71,12 +111,7 @@ class DiffusersEngine(BaseEngine):
         dtype = torch.float32 if self.device in ["mps", "cpu"] else torch.float16
 
         if is_local_ckpt:
-            logger.info(f"Loading from local checkpoint: {self.model_id}")
-            self.pipe = StableDiffusionInpaintPipeline.from_single_file(
-                self.model_id,
-                torch_dtype=dtype,
-                safety_checker=None,
-            )
+            self.pipe = self._load_single_file(StableDiffusionInpaintPipeline, dtype)
         else:
             logger.info(f"Loading from HuggingFace: {self.model_id}")
             self.pipe = StableDiffusionInpaintPipeline.from_pretrained(
@@ -103,6 +138,118 @@ class DiffusersEngine(BaseEngine):
 
         logger.info("Model loaded successfully")
 
+    def _load_single_file(self, pipeline_cls, dtype):
+        """
+        Загружает локальный чекпоинт.
+
+        from_single_file каждый раз распаковывает pickle и конвертирует ключи,
+        поэтому результат конвертации сохраняется один раз в safetensors
+        (diffusers-формат), а дальше грузится оттуда через mmap.
+        """
+        if self.converted_cache_dir is None:
+            logger.info(f"Loading from local checkpoint: {self.model_id}")
+            return pipeline_cls.from_single_file(
+                self.model_id,
+                torch_dtype=dtype,
+                safety_checker=None,
+            )
+
+        from utils.weights import converted_model_dir
+
+        dtype_name = str(dtype).replace("torch.", "")
+        converted_dir = converted_model_dir(
+            Path(self.model_id), Path(self.converted_cache_dir), dtype_name
+        )
+
+        if (converted_dir / "model_index.json").exists():
+            logger.info(f"Loading converted weights: {converted_dir}")
+            return pipeline_cls.from_pretrained(
+                converted_dir,
+                torch_dtype=dtype,
+                safety_checker=None,
+                local_files_only=True,
+                use_safetensors=True,
+            )
+
+        logger.info(f"Converting local checkpoint (one-time): {self.model_id}")
+        pipe = pipeline_cls.from_single_file(
+            self.model_id,
+            torch_dtype=dtype,
+            safety_checker=None,
+        )
+
+        # Пишем во временную папку и переименовываем, чтобы прерванная
+        # конвертация не оставила полукэш
+        tmp_dir = converted_dir.with_name(converted_dir.name + ".tmp")
+        try:
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            pipe.save_pretrained(tmp_dir, safe_serialization=True)
+            tmp_dir.rename(converted_dir)
+            logger.info(f"Converted weights saved: {converted_dir}")
+        except Exception as e:
+            logger.warning(f"Failed to save converted weights: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return pipe
+
+    def _configure_vae(self, size) -> None:
+        """
+        Включает tiled/sliced VAE для больших кадров.
+
+        На CPU/CUDA VAE на 1024px+ — пик потребления памяти; tiled-режим
+        diffusers кодирует/декодирует тайлами с перекрытием и плавно
+        смешивает швы. На MPS tiling ломает формы тензоров — не включаем.
+        """
+        if self.device == "mps" or self.vae_tiling_min_pixels is None:
+            return
+
+        use_tiling = size[0] * size[1] >= self.vae_tiling_min_pixels
+        if use_tiling == self._vae_tiled:
+            return
+
+        # Методы самого VAE: обёртки pipeline есть не во всех версиях diffusers
+        if use_tiling:
+            self.pipe.vae.enable_tiling()
+            self.pipe.vae.enable_slicing()
+        else:
+            self.pipe.vae.disable_tiling()
+            self.pipe.vae.disable_slicing()
+        self._vae_tiled = use_tiling
+        logger.info(f"VAE tiling {'enabled' if use_tiling else 'disabled'} for size={size}")
+
+    @contextmanager
+    def _feature_cache(self, interval: int):
+        """
+        DeepCache: кэширует выходы глубоких блоков UNet и переиспользует их
+        interval шагов подряд, пересчитывая только мелкие блоки.
+
+        Ускорение без дообучения; interval=1 — обычный инференс. Если пакет
+        DeepCache не установлен, работаем без кэширования.
+        """
+        if interval <= 1:
+            yield
+            return
+
+        try:
+            from DeepCache import DeepCacheSDHelper
+        except ImportError:
+            logger.warning("DeepCache not installed, running full UNet every step")
+            yield
+            return
+
+        helper = DeepCacheSDHelper(pipe=self.pipe)
+        helper.set_params(
+            cache_interval=interval,
+            cache_branch_id=self.deepcache_branch_id,
+        )
+        helper.enable()
+        logger.info(f"DeepCache enabled: interval={interval}, branch={self.deepcache_branch_id}")
+        try:
+            yield
+        finally:
+            helper.disable()
+
     def _load_controlnet(self) -> None:
         """Загружает ControlNet для lineart"""
         try:
@@ -127,6 +274,8 @@ class DiffusersEngine(BaseEngine):
         if self.pipe is not None:
             del self.pipe
             self.pipe = None
+            self._vae_tiled = False
+            self._prompt_cache = None
 
         if self.controlnet is not None:
             del self.controlnet
@@ -136,11 +285,13 @@ class DiffusersEngine(BaseEngine):
             del self.lineart_processor
             self.lineart_processor = None
 
-        # Очищаем память
-        if torch.backends.mps.is_available():
-            torch.mps.empty_cache()
-        elif torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        # Очищаем память (если torch не импортирован — модель не загружалась)
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            if torch.backends.mps.is_available():
+                torch.mps.empty_cache()
+            elif torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
         logger.info("Model unloaded")
 
@@ -155,11 +306,14 @@ class DiffusersEngine(BaseEngine):
         num_inference_steps: int = 30,
         controlnet_scale: float = 0.5,
         seed: Optional[int] = None,
+        deepcache_interval: int = 1,
     ) -> Image.Image:
         """Выполняет инпейнтинг"""
         if not self.is_loaded():
             raise RuntimeError("Model not loaded. Call load() first.")
 
+        import torch
+
         # Устанавливаем сид
         generator = None
         if seed is not None:
@@ -169,15 +323,9 @@ class DiffusersEngine(BaseEngine):
         if image.size != mask.size:
             mask = mask.resize(image.size, Image.Resampling.LANCZOS)
 
-        # Промпт по умолчанию для манхвы
-        if not prompt:
-            prompt = "clean background, manga style, high quality lineart"
+        prompt, negative_prompt = self._default_prompts(prompt, negative_prompt)
 
-        if not negative_prompt:
-            negative_prompt = (
-                "blurry, low quality, watermark, signature, "
-                "realistic, photo, 3d render, deformed"
-            )
+        self._configure_vae(image.size)
 
         logger.info(
             f"Running inpaint: size={image.size}, "
@@ -185,17 +333,132 @@ class DiffusersEngine(BaseEngine):
         )
 
         # Запускаем инпейнтинг
-        result = self.pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            image=image,
-            mask_image=mask,
-            strength=strength,
-            guidance_scale=guidance_scale,
-            num_inference_steps=num_inference_steps,
-            generator=generator,
-        ).images[0]
+        with self._feature_cache(deepcache_interval):
+            result = self.pipe(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=image,
+                mask_image=mask,
+                strength=strength,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps,
+                generator=generator,
+            ).images[0]
 
         logger.info("Inpaint completed")
 
         return result
+
+    def inpaint_batch(
+        self,
+        images: List[Image.Image],
+        masks: List[Image.Image],
+        prompt: str = "",
+        negative_prompt: str = "",
+        strength: float = 0.85,
+        guidance_scale: float = 7.5,
+        num_inference_steps: int = 30,
+        controlnet_scale: float = 0.5,
+        seed: Optional[int] = None,
+        deepcache_interval: int = 1,
+    ) -> List[Image.Image]:
+        """
+        Инпейнтинг нескольких кропов одного размера за один вызов pipeline.
+
+        Текстовые эмбеддинги считаются один раз и переиспользуются
+        для всего батча (и для следующих батчей с тем же промптом).
+        """
+        if not self.is_loaded():
+            raise RuntimeError("Model not loaded. Call load() first.")
+
+        size = images[0].size
+        if any(image.size != size for image in images):
+            raise ValueError("All images in a batch must have the same size")
+
+        import torch
+
+        generator = None
+        if seed is not None:
+            generator = torch.Generator(device=self.device).manual_seed(seed)
+
+        masks = [
+            mask if mask.size == size else mask.resize(size, Image.Resampling.LANCZOS)
+            for mask in masks
+        ]
+
+        prompt, negative_prompt = self._default_prompts(prompt, negative_prompt)
+        batch_size = len(images)
+        prompt_embeds, negative_prompt_embeds = self._encode_prompt(
+            prompt, negative_prompt, guidance_scale, batch_size
+        )
+
+        self._configure_vae(size)
+
+        logger.info(
+            f"Running batched inpaint: batch={batch_size}, size={size}, "
+            f"strength={strength}, steps={num_inference_steps}"
+        )
+
+        with self._feature_cache(deepcache_interval):
+            results = self.pipe(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                image=images,
+                mask_image=masks,
+                strength=strength,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps,
+                generator=generator,
+            ).images
+
+        logger.info("Batched inpaint completed")
+
+        return results
+
+    @staticmethod
+    def _default_prompts(prompt: str, negative_prompt: str) -> Tuple[str, str]:
+        """Промпты по умолчанию для манхвы"""
+        if not prompt:
+            prompt = "clean background, manga style, high quality lineart"
+
+        if not negative_prompt:
+            negative_prompt = (
+                "blurry, low quality, watermark, signature, "
+                "realistic, photo, 3d render, deformed"
+            )
+
+        return prompt, negative_prompt
+
+    def _encode_prompt(
+        self,
+        prompt: str,
+        negative_prompt: str,
+        guidance_scale: float,
+        batch_size: int,
+    ):
+        """
+        Текстовые эмбеддинги для батча с кэшем последнего промпта.
+
+        Считаются вне @no_grad __call__ pipeline, поэтому явно без autograd —
+        иначе кэш держал бы граф прохода CLIP между запросами.
+        """
+        import torch
+
+        key = (prompt, negative_prompt, guidance_scale > 1.0)
+        with torch.no_grad():
+            if self._prompt_cache is None or self._prompt_cache[0] != key:
+                embeds = self.pipe.encode_prompt(
+                    prompt,
+                    self.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=guidance_scale > 1.0,
+                    negative_prompt=negative_prompt,
+                )
+                self._prompt_cache = (key, embeds)
+
+            prompt_embeds, negative_prompt_embeds = self._prompt_cache[1]
+            prompt_embeds = prompt_embeds.repeat(batch_size, 1, 1)
+            if negative_prompt_embeds is not None:
+                negative_prompt_embeds = negative_prompt_embeds.repeat(batch_size, 1, 1)
+
+        return prompt_embeds, negative_prompt_embeds
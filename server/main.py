@@ -1,22 +1,37 @@
 """
 FastAPI сервер для инпейнтинга
 """
+import asyncio
 import logging
 from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Literal, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from PIL import Image
 from pydantic import BaseModel, Field
 
 import config
 from engines import DiffusersEngine
-from utils import base64_to_image, image_to_base64, CacheManager
+from utils import (
+    base64_to_image,
+    image_to_base64,
+    CacheManager,
+    InflightRegistry,
+    PeakMemoryMonitor,
+    Region,
+    group_regions,
+    combine_masks,
+    paste_region,
+)
 from utils.image import (
     ensure_rgb,
     ensure_mask_format,
     resize_for_model,
+    resize_for_region,
     apply_mask_feather,
     expand_mask,
 )
@@ -30,13 +45,29 @@ logger = logging.getLogger(__name__)
 
 # Глобальные объекты
 engine: Optional[DiffusersEngine] = None
-cache_manager: Optional[CacheManager] = None
+inflight = InflightRegistry()
+# Pipeline не потокобезопасен — загрузка/выгрузка/инференс строго по одному
+engine_lock = asyncio.Lock()
+
+
+async def ensure_engine_loaded() -> None:
+    """Загружает модель в пуле потоков (вызывать под engine_lock)"""
+    if not engine.is_loaded():
+        await run_in_threadpool(engine.load)
+
+
+async def warmup_engine() -> None:
+    """Фоновый импорт torch/diffusers, пока панель экспортирует кадр"""
+    try:
+        await run_in_threadpool(engine.warmup)
+    except Exception as e:
+        logger.warning(f"ML stack warmup failed: {e}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifecycle: загрузка/выгрузка модели"""
-    global engine, cache_manager
+    global engine
 
     logger.info("Starting server...")
 
@@ -44,11 +75,19 @@ async def lifespan(app: FastAPI):
     engine = DiffusersEngine(
         model_id=config.SDXL_INPAINT_MODEL,
         controlnet_id=config.CONTROLNET_MODEL if hasattr(config, 'CONTROLNET_MODEL') else None,
+        converted_cache_dir=config.CONVERTED_MODELS_DIR,
+        vae_tiling_min_pixels=config.VAE_TILING_MIN_PIXELS,
+        deepcache_branch_id=config.DEEPCACHE_BRANCH_ID,
     )
 
     # Предзагрузка модели (опционально, можно отложить)
     # engine.load()
 
+    # torch/diffusers импортируются в фоне — HTTP-слой, /health и
+    # попадания в кэш доступны сразу
+    if config.PRELOAD_ML_STACK:
+        app.state.warmup_task = asyncio.create_task(warmup_engine())
+
     logger.info("Server started")
     yield
 
@@ -82,6 +121,11 @@ class InpaintRequest(BaseModel):
     """Запрос на инпейнтинг"""
     image: str = Field(..., description="Base64 PNG изображения")
     mask: str = Field(..., description="Base64 PNG маски (белый = inpaint)")
+    masks: List[str] = Field(
+        default_factory=list,
+        description="Base64 PNG отдельных масок слоя: близкие области группируются "
+                    "и инпейнтятся кропами за один запрос (только mode=full)",
+    )
     prompt: str = Field(default="", description="Текстовый промпт")
     negative_prompt: str = Field(default="", description="Негативный промпт")
     strength: float = Field(default=0.85, ge=0.0, le=1.0)
@@ -92,6 +136,21 @@ class InpaintRequest(BaseModel):
     feather: int = Field(default=0, ge=0, le=50, description="Feather маски в px")
     expand: int = Field(default=0, ge=0, le=50, description="Expand маски в px")
     cache_dir: Optional[str] = Field(default=None, description="Путь к папке кэша проекта")
+    mode: Literal["full", "draft", "refine"] = Field(
+        default="full",
+        description="full — обычный проход; draft — быстрый черновик в низком "
+                    "разрешении; refine — уточнение черновика (черновик берётся "
+                    "из кэша или считается автоматически)",
+    )
+    deepcache_interval: int = Field(
+        default=1, ge=1, le=10,
+        description="Быстрый режим: полный пересчёт UNet раз в N шагов "
+                    "(1 = выключен; больше — быстрее, но ниже качество)",
+    )
+    refine_strength: float = Field(
+        default=config.DEFAULT_REFINE_STRENGTH, ge=0.0, le=1.0,
+        description="Сила деноизинга при уточнении черновика",
+    )
 
 
 class InpaintResponse(BaseModel):
@@ -100,6 +159,13 @@ class InpaintResponse(BaseModel):
     cached: bool = Field(default=False, description="Результат из кэша")
     width: int
     height: int
+    mode: str = Field(default="full", description="Режим, которым получен результат")
+    deepcache_interval: int = Field(
+        default=1, description="Применённый быстрый режим (1 = полный UNet)"
+    )
+    peak_memory_mb: Optional[float] = Field(
+        default=None, description="Пик памяти за инференс (VRAM на CUDA, RSS иначе)"
+    )
 
 
 class HealthResponse(BaseModel):
@@ -119,7 +185,7 @@ async def health_check():
         status="ok",
         engine=engine.name if engine else "none",
         engine_loaded=engine.is_loaded() if engine else False,
-        device=engine.device if engine else "unknown",
+        device=(engine.known_device() or "pending") if engine else "unknown",
     )
 
 
@@ -133,7 +199,8 @@ async def load_model():
         return {"status": "already_loaded"}
 
     try:
-        engine.load()
+        async with engine_lock:
+            await ensure_engine_loaded()
         return {"status": "loaded"}
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
@@ -146,27 +213,132 @@ async def unload_model():
     if engine is None:
         raise HTTPException(status_code=500, detail="Engine not initialized")
 
-    engine.unload()
+    # Ждём завершения текущего инференса
+    async with engine_lock:
+        engine.unload()
     return {"status": "unloaded"}
 
 
+async def run_pass(
+    cache_manager: Optional[CacheManager],
+    image: Image.Image,
+    mask: Image.Image,
+    params: dict,
+    prompt: str,
+    negative_prompt: str,
+    infer: Callable[[], Image.Image],
+    prefix: str = "inpaint",
+) -> Tuple[Image.Image, bool, Optional[float]]:
+    """
+    Один проход инпейнтинга: кэш -> single-flight -> инференс -> кэш.
+
+    image/mask/prompt/params задают ключ кэша, infer выполняет инференс
+    (в пуле потоков). Одинаковые запросы объединяются только в пределах
+    одной папки кэша и одного негативного промпта.
+
+    Returns:
+        (результат, из кэша ли, пик памяти в MB)
+    """
+    # Проверяем кэш
+    if cache_manager:
+        cached_result = cache_manager.get_cached_result(
+            image, mask, prompt, params, prefix
+        )
+        if cached_result is not None:
+            logger.info(f"Returning cached result ({prefix})")
+            return cached_result, True, None
+
+    async def run_inpaint():
+        # Выполняем инпейнтинг вне event loop, чтобы /health и
+        # повторные запросы обрабатывались во время инференса
+        async with engine_lock:
+            # Автозагрузка модели при первом запросе (после проверки
+            # кэша — попадания в кэш не ждут ML-стек)
+            if not engine.is_loaded():
+                logger.info("Auto-loading model on first request...")
+                try:
+                    await ensure_engine_loaded()
+                except Exception as e:
+                    logger.error(f"Failed to auto-load model: {e}")
+                    raise HTTPException(status_code=500, detail=f"Failed to load model: {e}")
+
+            memory = PeakMemoryMonitor(engine.device)
+            with memory:
+                result = await run_in_threadpool(infer)
+            logger.info(f"Peak memory during {prefix}: {memory.peak_mb} MB")
+
+        # Сохраняем в кэш
+        if cache_manager:
+            cache_manager.save_to_cache(image, mask, result, prompt, params, prefix)
+        return result, memory.peak_mb
+
+    # Одинаковые запросы в полёте выполняются один раз
+    cache_key = CacheManager.get_cache_key(image, mask, prompt, params, prefix)
+    flight_key = (
+        str(cache_manager.cache_dir) if cache_manager else None,
+        negative_prompt,
+        cache_key,
+    )
+    (result, peak_memory_mb), coalesced = await inflight.run(flight_key, run_inpaint)
+    if coalesced:
+        logger.info("Returning result of coalesced in-flight request")
+
+    return result, False, peak_memory_mb
+
+
+def inpaint_regions(
+    image: Image.Image,
+    regions: List[Region],
+    engine_kwargs: dict,
+) -> Image.Image:
+    """
+    Инпейнтит регионы по кропам и собирает один кадр.
+
+    Кропы одинакового размера после ресайза идут одним батчем
+    (не больше REGION_MAX_BATCH за вызов).
+    """
+    by_size = {}
+    for region in regions:
+        crop = resize_for_region(
+            image.crop(region.box), config.REGION_MIN_SIZE, config.REGION_MAX_SIZE
+        )
+        crop_mask = region.mask.resize(crop.size)
+        by_size.setdefault(crop.size, []).append((region, crop, crop_mask))
+
+    result = image.copy()
+    for size, items in by_size.items():
+        for start in range(0, len(items), config.REGION_MAX_BATCH):
+            batch = items[start:start + config.REGION_MAX_BATCH]
+            logger.info(f"Inpainting {len(batch)} region(s) at {size}")
+            outputs = engine.inpaint_batch(
+                [crop for _, crop, _ in batch],
+                [crop_mask for _, _, crop_mask in batch],
+                **engine_kwargs,
+            )
+            for (region, _, _), output in zip(batch, outputs):
+                paste_region(result, output, region)
+
+    return result
+
+
+def prepare_mask(mask_b64: str, size: Tuple[int, int], request: InpaintRequest) -> Image.Image:
+    """Декодирует маску и применяет feather/expand из запроса"""
+    mask = ensure_mask_format(base64_to_image(mask_b64))
+    if request.feather > 0:
+        mask = apply_mask_feather(mask, request.feather)
+    if request.expand > 0:
+        mask = expand_mask(mask, request.expand)
+    if mask.size != size:
+        mask = mask.resize(size)
+    return mask
+
+
 @app.post("/inpaint", response_model=InpaintResponse)
 async def inpaint(request: InpaintRequest):
     """Выполняет инпейнтинг"""
-    global cache_manager
-
     if engine is None:
         raise HTTPException(status_code=500, detail="Engine not initialized")
 
-    # Автозагрузка модели при первом запросе
-    if not engine.is_loaded():
-        logger.info("Auto-loading model on first request...")
-        try:
-            engine.load()
-        except Exception as e:
-            logger.error(f"Failed to auto-load model: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to load model: {e}")
-
     try:
         # Debug: log received data sizes
         logger.info(f"Received image base64 length: {len(request.image)}")
@@ -190,6 +362,7 @@ async def inpaint(request: InpaintRequest):
 
         # Ресайз для модели
         original_size = image.size
+        source_image = image
         image = resize_for_model(image)
         mask = mask.resize(image.size)
 
@@ -203,47 +376,98 @@ async def inpaint(request: InpaintRequest):
             "expand": request.expand,
             "seed": request.seed,
         }
-
-        # Проверяем кэш
+        # Быстрый режим — только если движок его реально применит
+        deepcache_interval = request.deepcache_interval
+        if deepcache_interval > 1 and not engine.supports_feature_cache:
+            logger.warning("Fast mode requested but DeepCache is not available, using full UNet")
+            deepcache_interval = 1
+        # Только если включён — старые ключи кэша остаются валидными
+        if deepcache_interval > 1:
+            params["deepcache_interval"] = deepcache_interval
+
+        cache_manager = None
         if config.CACHE_ENABLED and request.cache_dir:
             cache_dir = Path(request.cache_dir) / config.CACHE_DIR_NAME
             output_dir = Path(request.cache_dir) / config.OUTPUT_DIR_NAME
-            cache_manager = CacheManager(cache_dir, output_dir)
-
-            cached_result = cache_manager.get_cached_result(
-                image, mask, request.prompt, params
+            cache_manager = CacheManager(
+                cache_dir,
+                output_dir,
+                near_match_distance=config.CACHE_NEAR_MATCH_DISTANCE,
+                near_match_pixel_diff=config.CACHE_NEAR_MATCH_PIXEL_DIFF,
             )
-            if cached_result is not None:
-                logger.info("Returning cached result")
-                # Возвращаем к оригинальному размеру
-                if cached_result.size != original_size:
-                    cached_result = cached_result.resize(original_size)
-
-                return InpaintResponse(
-                    result=image_to_base64(cached_result),
-                    cached=True,
-                    width=cached_result.width,
-                    height=cached_result.height,
-                )
 
-        # Выполняем инпейнтинг
-        result = engine.inpaint(
-            image=image,
-            mask=mask,
-            prompt=request.prompt,
-            negative_prompt=request.negative_prompt or config.DEFAULT_NEGATIVE_PROMPT,
-            strength=request.strength,
-            guidance_scale=request.guidance_scale,
-            num_inference_steps=request.num_steps,
-            controlnet_scale=request.controlnet_scale,
-            seed=request.seed,
-        )
+        engine_kwargs = {
+            "prompt": request.prompt,
+            "negative_prompt": request.negative_prompt or config.DEFAULT_NEGATIVE_PROMPT,
+            "strength": request.strength,
+            "guidance_scale": request.guidance_scale,
+            "num_inference_steps": request.num_steps,
+            "controlnet_scale": request.controlnet_scale,
+            "seed": request.seed,
+            "deepcache_interval": deepcache_interval,
+        }
 
-        # Сохраняем в кэш
-        if config.CACHE_ENABLED and cache_manager:
-            cache_manager.save_to_cache(
-                image, mask, result, request.prompt, params
+        if request.masks and request.mode == "full":
+            # Несколько масок: регионы кропами в исходном разрешении
+            region_masks = [prepare_mask(m, original_size, request) for m in request.masks]
+            regions = group_regions(
+                region_masks,
+                original_size,
+                padding=config.REGION_PADDING,
+                min_padding=config.REGION_MIN_PADDING,
             )
+            if not regions:
+                raise HTTPException(status_code=400, detail="All masks are empty")
+            logger.info(f"{len(request.masks)} mask(s) grouped into {len(regions)} region(s)")
+
+            result, cached, peak_memory_mb = await run_pass(
+                cache_manager,
+                source_image,
+                combine_masks(region_masks),
+                {**params, "regions": [list(region.box) for region in regions]},
+                request.prompt,
+                engine_kwargs["negative_prompt"],
+                partial(inpaint_regions, source_image, regions, engine_kwargs),
+                prefix="regions",
+            )
+        elif request.mode == "full":
+            result, cached, peak_memory_mb = await run_pass(
+                cache_manager, image, mask, params,
+                request.prompt, engine_kwargs["negative_prompt"],
+                partial(engine.inpaint, image=image, mask=mask, **engine_kwargs),
+            )
+        else:
+            # Черновик: низкое разрешение, мало шагов
+            draft_image = resize_for_model(image, max_size=config.DRAFT_MAX_SIZE)
+            draft_mask = mask.resize(draft_image.size)
+            draft_kwargs = {**engine_kwargs, "num_inference_steps": config.DRAFT_NUM_STEPS}
+            result, cached, peak_memory_mb = await run_pass(
+                cache_manager,
+                draft_image,
+                draft_mask,
+                {**params, "draft_max_size": config.DRAFT_MAX_SIZE, "draft_steps": config.DRAFT_NUM_STEPS},
+                request.prompt,
+                engine_kwargs["negative_prompt"],
+                partial(engine.inpaint, image=draft_image, mask=draft_mask, **draft_kwargs),
+                prefix="draft",
+            )
+
+            if request.mode == "refine":
+                # Уточнение: апскейл черновика в полное разрешение и проход
+                # с пониженной силой — старт от черновика, а не от шума
+                draft_up = result.resize(image.size, Image.Resampling.LANCZOS)
+                refine_image = Image.composite(draft_up, image, mask)
+                refine_kwargs = {**engine_kwargs, "strength": request.refine_strength}
+                result, cached, peak_memory_mb = await run_pass(
+                    cache_manager,
+                    refine_image,
+                    mask,
+                    {**params, "refine_strength": request.refine_strength},
+                    request.prompt,
+                    engine_kwargs["negative_prompt"],
+                    partial(engine.inpaint, image=refine_image, mask=mask, **refine_kwargs),
+                    prefix="refine",
+                )
 
         # Возвращаем к оригинальному размеру
         if result.size != original_size:
@@ -251,11 +475,16 @@ async def inpaint(request: InpaintRequest):
 
         return InpaintResponse(
             result=image_to_base64(result),
-            cached=False,
+            cached=cached,
             width=result.width,
             height=result.height,
+            mode=request.mode,
+            deepcache_interval=deepcache_interval,
+            peak_memory_mb=peak_memory_mb,
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Inpaint failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
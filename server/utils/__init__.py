@@ -1,4 +1,19 @@
 from .image import image_to_base64, base64_to_image
 from .cache import CacheManager
+from .inflight import InflightRegistry
+from .weights import converted_model_dir
+from .memory import PeakMemoryMonitor
+from .regions import Region, group_regions, combine_masks, paste_region
 
-__all__ = ["image_to_base64", "base64_to_image", "CacheManager"]
+__all__ = [
+    "image_to_base64",
+    "base64_to_image",
+    "CacheManager",
+    "InflightRegistry",
+    "converted_model_dir",
+    "PeakMemoryMonitor",
+    "Region",
+    "group_regions",
+    "combine_masks",
+    "paste_region",
+]
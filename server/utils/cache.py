@@ -3,24 +3,46 @@
 """
 import hashlib
 import json
+import logging
 from pathlib import Path
 from typing import Optional
 from PIL import Image
 
-from .image import image_to_base64
+from .image import image_to_base64, perceptual_hash, max_pixel_difference
+
+logger = logging.getLogger(__name__)
+
+NEAR_INDEX_NAME = "near_index.json"
 
 
 class CacheManager:
     """Менеджер кэша для инпейнтинга"""
 
-    def __init__(self, cache_dir: Path, output_dir: Path):
+    def __init__(
+        self,
+        cache_dir: Path,
+        output_dir: Path,
+        near_match_distance: Optional[int] = None,
+        near_match_pixel_diff: int = 8,
+    ):
+        """
+        Args:
+            cache_dir: Папка входных данных и метаданных
+            output_dir: Папка результатов
+            near_match_distance: Допуск (в битах) перцептивного хэша для
+                приблизительного поиска; None = только точное совпадение
+            near_match_pixel_diff: Максимальная поканальная разница пикселей,
+                при которой кадр считается тем же самым
+        """
         self.cache_dir = cache_dir
         self.output_dir = output_dir
+        self.near_match_distance = near_match_distance
+        self.near_match_pixel_diff = near_match_pixel_diff
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
+    @staticmethod
     def _compute_hash(
-        self,
         image: Image.Image,
         mask: Image.Image,
         prompt: str,
@@ -44,18 +66,117 @@ class CacheManager:
 
         return hasher.hexdigest()[:16]
 
+    @classmethod
     def get_cache_key(
-        self,
+        cls,
         image: Image.Image,
         mask: Image.Image,
         prompt: str,
         params: dict,
         prefix: str = "inpaint"
     ) -> str:
-        """Генерирует ключ кэша"""
-        hash_str = self._compute_hash(image, mask, prompt, params)
+        """Генерирует ключ кэша (не зависит от папки кэша)"""
+        hash_str = cls._compute_hash(image, mask, prompt, params)
         return f"{prefix}_{hash_str}"
 
+    @staticmethod
+    def _compute_group_hash(
+        image: Image.Image,
+        mask: Image.Image,
+        prompt: str,
+        params: dict
+    ) -> str:
+        """Точный hash всего, кроме пикселей изображения (маска, промпт, параметры)"""
+        hasher = hashlib.md5()
+        hasher.update(f"{image.size}".encode("utf-8"))
+        hasher.update(mask.tobytes())
+        hasher.update(prompt.encode("utf-8"))
+        hasher.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return hasher.hexdigest()[:16]
+
+    def _load_near_index(self) -> dict:
+        """Индекс: group hash -> [{phash, key}]"""
+        index_path = self.cache_dir / NEAR_INDEX_NAME
+        if not index_path.exists():
+            return {}
+        try:
+            return json.loads(index_path.read_text())
+        except ValueError:
+            logger.warning(f"Corrupted near-match index, ignoring: {index_path}")
+            return {}
+
+    def _find_near_match(
+        self,
+        image: Image.Image,
+        mask: Image.Image,
+        prompt: str,
+        params: dict,
+        prefix: str
+    ) -> Optional[Path]:
+        """
+        Ищет результат для визуально идентичного кадра.
+
+        Маска/промпт/параметры должны совпадать точно, изображение —
+        по перцептивному хэшу в пределах допуска. Кандидаты проверяются
+        попиксельно по сохранённому входу, от ближайшего к дальнему.
+        """
+        entries = self._load_near_index().get(
+            self._compute_group_hash(image, mask, prompt, params), []
+        )
+        if not entries:
+            return None
+
+        phash = perceptual_hash(image, mask)
+        candidates = []
+        for entry in entries:
+            if not entry["key"].startswith(f"{prefix}_"):
+                continue
+            distance = bin(phash ^ int(entry["phash"], 16)).count("1")
+            if distance <= self.near_match_distance:
+                candidates.append((distance, entry["key"]))
+
+        for distance, cache_key in sorted(candidates):
+            input_path = self.cache_dir / f"{cache_key}_input.png"
+            result_path = self.output_dir / f"{cache_key}_result.png"
+            if not input_path.exists() or not result_path.exists():
+                continue
+
+            with Image.open(input_path) as cached_input:
+                if cached_input.size != image.size:
+                    continue
+                diff = max_pixel_difference(cached_input.convert(image.mode), image)
+
+            if diff <= self.near_match_pixel_diff:
+                logger.info(
+                    f"Near-duplicate cache hit: {cache_key} "
+                    f"(phash distance={distance}, max pixel diff={diff})"
+                )
+                return result_path
+
+        return None
+
+    def _add_to_near_index(
+        self,
+        cache_key: str,
+        image: Image.Image,
+        mask: Image.Image,
+        prompt: str,
+        params: dict
+    ) -> None:
+        """Добавляет запись в индекс приблизительного поиска"""
+        index = self._load_near_index()
+        entries = index.setdefault(
+            self._compute_group_hash(image, mask, prompt, params), []
+        )
+        if any(entry["key"] == cache_key for entry in entries):
+            return
+
+        entries.append({
+            "phash": format(perceptual_hash(image, mask), "x"),
+            "key": cache_key,
+        })
+        (self.cache_dir / NEAR_INDEX_NAME).write_text(json.dumps(index))
+
     def get_cached_result(
         self,
         image: Image.Image,
@@ -71,6 +192,11 @@ class CacheManager:
         if result_path.exists():
             return Image.open(result_path)
 
+        if self.near_match_distance is not None:
+            near_path = self._find_near_match(image, mask, prompt, params, prefix)
+            if near_path is not None:
+                return Image.open(near_path)
+
         return None
 
     def save_to_cache(
@@ -105,6 +231,9 @@ class CacheManager:
         }
         meta_path.write_text(json.dumps(meta, indent=2))
 
+        if self.near_match_distance is not None:
+            self._add_to_near_index(cache_key, image, mask, prompt, params)
+
         return result_path
 
     def clear_cache(self):
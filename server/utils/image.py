@@ -103,3 +103,78 @@ def expand_mask(mask: Image.Image, expand_px: int) -> Image.Image:
         mask = mask.filter(ImageFilter.MaxFilter(3))
 
     return mask
+
+
+def perceptual_hash(
+    image: Image.Image,
+    mask: Image.Image,
+    hash_size: int = 16,
+    context: float = 0.25,
+) -> int:
+    """
+    dHash области маски (с контекстом вокруг) — устойчив к шуму в младших
+    битах цвета, который появляется при повторном рендере кадра в AE.
+
+    Returns:
+        hash_size * hash_size бит в виде int
+    """
+    bbox = mask.getbbox() or (0, 0, image.width, image.height)
+    left, top, right, bottom = bbox
+    pad_x = int((right - left) * context)
+    pad_y = int((bottom - top) * context)
+    region = image.crop((
+        max(0, left - pad_x),
+        max(0, top - pad_y),
+        min(image.width, right + pad_x),
+        min(image.height, bottom + pad_y),
+    ))
+
+    small = region.convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.BOX
+    )
+    pixels = list(small.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bit = pixels[offset + col] > pixels[offset + col + 1]
+            value = (value << 1) | int(bit)
+    return value
+
+
+def max_pixel_difference(a: Image.Image, b: Image.Image) -> int:
+    """Максимальная поканальная разница между изображениями одного размера"""
+    from PIL import ImageChops
+
+    extrema = ImageChops.difference(a, b).getextrema()
+    if isinstance(extrema[0], tuple):
+        return max(high for _, high in extrema)
+    return extrema[1]
+
+
+def resize_for_region(
+    image: Image.Image,
+    min_size: int = 512,
+    max_size: int = 1024,
+) -> Image.Image:
+    """
+    Ресайз кропа региона для модели: длинная сторона в [min_size, max_size],
+    размеры кратны 8. Мелкие кропы увеличиваются — SD плохо работает
+    на разрешениях сильно ниже родного.
+    """
+    w, h = image.size
+    long_side = max(w, h)
+
+    ratio = 1.0
+    if long_side < min_size:
+        ratio = min_size / long_side
+    elif long_side > max_size:
+        ratio = max_size / long_side
+
+    new_w = max(8, (int(w * ratio) // 8) * 8)
+    new_h = max(8, (int(h * ratio) // 8) * 8)
+    if (new_w, new_h) == (w, h):
+        return image
+
+    return image.resize((new_w, new_h), Image.Resampling.LANCZOS)
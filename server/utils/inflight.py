@@ -0,0 +1,53 @@
+"""
+Дедупликация одинаковых запросов, выполняющихся одновременно (single-flight)
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class InflightRegistry:
+    """
+    Реестр выполняющихся задач по ключу кэша.
+
+    Кэш в CacheManager заполняется только после завершения инференса,
+    поэтому повтор запроса (ретрай панели по таймауту, два клика по
+    одному слою) запустил бы ту же диффузию повторно. Здесь повторный
+    запрос с тем же ключом подключается к уже идущей задаче и получает
+    её результат.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[T]],
+    ) -> Tuple[T, bool]:
+        """
+        Выполняет func или подключается к уже идущей задаче с тем же ключом.
+
+        Returns:
+            (результат, True если результат получен от чужой задачи)
+        """
+        job = self._jobs.get(key)
+        if job is not None:
+            logger.info(f"Attaching to in-flight job: {key}")
+            # shield: отключение клиента не должно отменять общую задачу
+            return await asyncio.shield(job), True
+
+        job = asyncio.ensure_future(func())
+        self._jobs[key] = job
+        job.add_done_callback(lambda _: self._forget(key, job))
+
+        return await asyncio.shield(job), False
+
+    def _forget(self, key: Hashable, job: asyncio.Future) -> None:
+        """Удаляет завершённую задачу из реестра"""
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
@@ -0,0 +1,75 @@
+"""
+Замер пикового потребления памяти за время запроса
+"""
+import logging
+import os
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _current_rss() -> Optional[int]:
+    """Текущий RSS процесса в байтах (None, если узнать нельзя)"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+class PeakMemoryMonitor:
+    """
+    Контекстный менеджер: пик памяти за время блока.
+
+    CUDA — пик выделенной видеопамяти (torch.cuda.max_memory_allocated).
+    CPU/MPS — пик RSS процесса по фоновым замерам (psutil или /proc);
+    если текущий RSS узнать нельзя, пик не сообщается (None).
+    """
+
+    def __init__(self, device: str, interval: float = 0.05):
+        self.device = device
+        self.interval = interval
+        self.peak_bytes: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def peak_mb(self) -> Optional[float]:
+        if self.peak_bytes is None:
+            return None
+        return round(self.peak_bytes / (1024 * 1024), 1)
+
+    def __enter__(self) -> "PeakMemoryMonitor":
+        if self.device == "cuda":
+            import torch
+
+            torch.cuda.reset_peak_memory_stats()
+        elif _current_rss() is not None:
+            self.peak_bytes = _current_rss()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.device == "cuda":
+            import torch
+
+            self.peak_bytes = torch.cuda.max_memory_allocated()
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak_bytes = max(self.peak_bytes, _current_rss() or 0)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = _current_rss()
+            if rss is not None and rss > self.peak_bytes:
+                self.peak_bytes = rss
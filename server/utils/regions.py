@@ -0,0 +1,94 @@
+"""
+Группировка нескольких масок слоя в регионы для инпейнтинга по кропам
+"""
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from PIL import Image, ImageChops
+
+Box = Tuple[int, int, int, int]
+
+
+@dataclass
+class Region:
+    """Регион инпейнтинга: кроп кадра и маска в его координатах"""
+    box: Box
+    mask: Image.Image
+
+
+def combine_masks(masks: List[Image.Image]) -> Image.Image:
+    """Объединение масок (поэлементный максимум)"""
+    combined = masks[0]
+    for mask in masks[1:]:
+        combined = ImageChops.lighter(combined, mask)
+    return combined
+
+
+def _pad_box(box: Box, padding: float, min_padding: int, size: Tuple[int, int]) -> Box:
+    """Расширяет рамку маски контекстом вокруг, не выходя за кадр"""
+    left, top, right, bottom = box
+    pad_x = max(min_padding, int((right - left) * padding))
+    pad_y = max(min_padding, int((bottom - top) * padding))
+    return (
+        max(0, left - pad_x),
+        max(0, top - pad_y),
+        min(size[0], right + pad_x),
+        min(size[1], bottom + pad_y),
+    )
+
+
+def _boxes_overlap(a: Box, b: Box) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _union_box(a: Box, b: Box) -> Box:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def group_regions(
+    masks: List[Image.Image],
+    image_size: Tuple[int, int],
+    padding: float = 0.5,
+    min_padding: int = 32,
+) -> List[Region]:
+    """
+    Объединяет близкие маски в регионы.
+
+    Рамка каждой маски расширяется на padding от своего размера (но не
+    меньше min_padding px) — это контекст для модели. Пересекающиеся
+    рамки сливаются, пока сливать больше нечего. Пустые маски пропускаются.
+    """
+    groups = []
+    for mask in masks:
+        bbox = mask.getbbox()
+        if bbox is None:
+            continue
+        groups.append((_pad_box(bbox, padding, min_padding, image_size), [mask]))
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                if _boxes_overlap(groups[i][0], groups[j][0]):
+                    box = _union_box(groups[i][0], groups[j][0])
+                    groups[i] = (box, groups[i][1] + groups[j][1])
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [
+        Region(box=box, mask=combine_masks(group_masks).crop(box))
+        for box, group_masks in groups
+    ]
+
+
+def paste_region(target: Image.Image, result: Image.Image, region: Region) -> None:
+    """Вклеивает результат региона в кадр по его маске (с учётом feather)"""
+    width = region.box[2] - region.box[0]
+    height = region.box[3] - region.box[1]
+    if result.size != (width, height):
+        result = result.resize((width, height), Image.Resampling.LANCZOS)
+    target.paste(result, region.box[:2], region.mask)
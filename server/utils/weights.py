@@ -0,0 +1,62 @@
+"""
+Кэш сконвертированных весов single-file чекпоинтов
+"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+HASH_INDEX_NAME = "hashes.json"
+
+
+def file_hash(path: Path, index_dir: Path) -> str:
+    """
+    Возвращает sha256 файла чекпоинта.
+
+    Полный хэш многогигабайтного .ckpt считается только один раз:
+    результат запоминается в index_dir/hashes.json по (путь, размер, mtime),
+    так что повторные старты сервера не перечитывают файл.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    index_path = index_dir / HASH_INDEX_NAME
+
+    index = {}
+    if index_path.exists():
+        try:
+            index = json.loads(index_path.read_text())
+        except ValueError:
+            logger.warning(f"Corrupted hash index, rebuilding: {index_path}")
+
+    entry = index.get(str(path))
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    logger.info(f"Hashing checkpoint (one-time): {path}")
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    index[str(path)] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest,
+    }
+    index_dir.mkdir(parents=True, exist_ok=True)
+    index_path.write_text(json.dumps(index, indent=2))
+
+    return digest
+
+
+def converted_model_dir(
+    checkpoint: Path,
+    cache_root: Path,
+    dtype_name: str,
+) -> Path:
+    """Путь к diffusers-копии чекпоинта (ключ: хэш файла + dtype)"""
+    digest = file_hash(checkpoint, cache_root)
+    return cache_root / f"{Path(checkpoint).stem}-{digest[:16]}-{dtype_name}"